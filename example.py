@@ -16,18 +16,17 @@ async def main():
     await exchange.load_markets()
     print(f"✅ Loaded {len(exchange.markets)} markets")
     
-    # Fetch balance
-    balance = await exchange.fetch_balance()
+    # Fetch balance, ticker and positions concurrently
+    balance, ticker, positions = await asyncio.gather(
+        exchange.fetch_balance(),
+        exchange.fetch_ticker('BTC/USDT:USDT'),
+        exchange.fetch_positions(params={'onlyNonZero': True}),
+    )
+    
     usdt = balance.get('USDT', {})
     print(f"💰 USDT Balance: {usdt.get('total', 0):.2f}")
-    
-    # Fetch ticker
-    ticker = await exchange.fetch_ticker('BTC/USDT:USDT')
     print(f"📊 BTC Price: ${ticker['last']:,.2f}")
-    
-    # Fetch positions
-    positions = await exchange.fetch_positions()
-    print(f"📈 Open Positions: {len([p for p in positions if p['contracts'] != 0])}")
+    print(f"📈 Open Positions: {len(positions)}")
     
     # Place a test order (uncomment to use)
     # order = await exchange.create_order(
@@ -37,5 +36,15 @@ async def main():
     #     amount=0.01
     # )
     # print(f"🎯 Order placed: {order['id']}")
+    
+    # Place several orders in one signed request (uncomment to use)
+    # orders = await exchange.create_orders([
+    #     {'symbol': 'BTC/USDT:USDT', 'type': 'MARKET', 'side': 'BUY', 'amount': 0.01},
+    #     {'symbol': 'ETH/USDT:USDT', 'type': 'MARKET', 'side': 'BUY', 'amount': 0.1},
+    # ])
+    # print(f"🎯 Orders placed: {[o.get('id') for o in orders]}")
+    
+    # Release the shared HTTP session
+    await exchange.close_session()
 if __name__ == "__main__":
     asyncio.run(main())
@@ -3,31 +3,99 @@ CCXT Binance Futures Testnet Fix
 ================================
 Bypass solution for CCXT's deprecated sandbox mode on Binance Futures.
 Usage:
-    from exchange_factory import ExchangeFactory
+    from exchange_factory import BinanceTestnetError, ExchangeFactory
     
     exchange = ExchangeFactory.create_binance_demo(
         api_key="YOUR_API_KEY",
         secret="YOUR_SECRET"
     )
+    
+    # Inside a coroutine; the HTTP session is opened on the first request
+    balance = await exchange.fetch_balance()
+    await exchange.close_session()
 """
+import asyncio
 import ccxt
 import types
 import hashlib
 import hmac
 import time
 import aiohttp
-from urllib.parse import urlencode
+import orjson
+import yarl
+from functools import lru_cache
+from urllib.parse import quote_plus
+
+BASE_URL = "https://testnet.binancefuture.com"
+
+# Fixed leading fields of a /fapi/v1/order request, in query-string order
+ORDER_KEYS = ('symbol', 'side', 'type', 'quantity')
+# Keys that caller params may not override (recvWindow/timestamp are added when signing)
+RESERVED_ORDER_KEYS = ORDER_KEYS + ('recvWindow', 'timestamp')
+LIMIT_ORDER_KEYS = RESERVED_ORDER_KEYS + ('price', 'timeInForce')
+
+# Binance Futures accepts at most 5 orders per /fapi/v1/batchOrders request
+BATCH_ORDER_LIMIT = 5
+
+# Seconds before the background warm-up ping gives up
+PRECONNECT_TIMEOUT = 5
+
+# positionRisk responses with at least this many rows are parsed in a worker thread
+POSITIONS_EXECUTOR_THRESHOLD = 200
+
+
+class BinanceTestnetError(Exception):
+    """Raised when the testnet answers with a non-200 status; the message is built lazily."""
+    
+    def __init__(self, status, data, action='Request'):
+        super().__init__(status, data)
+        self.status = status
+        self.data = data
+        self.action = action
+    
+    def __str__(self):
+        return f"{self.action} failed ({self.status}): {self.data}"
+
+
+def parse_positions(data, only_non_zero=False):
+    """Convert a /fapi/v2/positionRisk response into ccxt-style position dicts."""
+    f = float
+    return [{
+        'info': item,
+        'symbol': item['symbol'],
+        'contracts': amount,
+        'unrealizedPnl': f(item['unRealizedProfit']),
+        'leverage': f(item['leverage']),
+        'side': 'long' if amount > 0 else 'short',
+        'entryPrice': f(item['entryPrice']),
+    } for item in data
+        if (amount := f(item['positionAmt'])) != 0.0 or not only_non_zero]
+
+
+def encode_value(value):
+    """Quote a query value, JSON-encoding dicts and lists (e.g. batchOrders)."""
+    if isinstance(value, (dict, list)):
+        return quote_plus(orjson.dumps(value).decode('utf-8'))
+    return quote_plus(str(value))
+
+
+def encode_query(params, skip=()):
+    """Build a query string from params, leaving out keys in skip."""
+    return '&'.join(f"{key}={encode_value(value)}" for key, value in params.items() if key not in skip)
+
+
 class ExchangeFactory:
     """Factory for creating exchange instances with testnet patches."""
     
     @classmethod
-    def create_binance_demo(cls, api_key: str, secret: str):
+    def create_binance_demo(cls, api_key: str, secret: str, ticker_ttl: float = 0):
         """
         Create a Binance Futures instance that works with Demo/Testnet.
         
         Args:
             api_key: Your Binance Demo API key
             secret: Your Binance Demo secret key
+            ticker_ttl: Seconds to reuse a fetched ticker per symbol (0 disables caching)
             
         Returns:
             Patched ccxt.binance instance
@@ -44,145 +112,278 @@ class ExchangeFactory:
         })
         
         instance.set_sandbox_mode(True)
+        # Created lazily on the first request so the factory works outside an event loop
+        instance._session = None
+        instance._warmup_task = None
+        instance._market_cache = {}
+        instance._market_cache_source = None
+        instance._ticker_ttl = ticker_ttl
+        instance._ticker_cache = {}
+        instance._ticker_locks = {}
+        instance._secret_bytes = secret.encode('utf-8')
+        instance._hmac_template = hmac.new(instance._secret_bytes, b'', hashlib.sha256)
+        instance._headers = {'X-MBX-APIKEY': api_key}
         cls._apply_patches(instance)
         
         return instance
     
+    @staticmethod
+    async def _preconnect(session):
+        """Ping the testnet once to warm the connection pool; failures are ignored."""
+        try:
+            timeout = aiohttp.ClientTimeout(total=PRECONNECT_TIMEOUT)
+            async with session.get(f"{BASE_URL}/fapi/v1/ping", ssl=False, timeout=timeout) as response:
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            pass
+    
     @classmethod
     def _apply_patches(cls, instance):
         """Apply all necessary patches to the instance."""
         
-        # PATCH 1: fetch_balance
-        async def patched_fetch_balance(self, params={}):
-            timestamp = int(time.time() * 1000)
-            payload = {'timestamp': timestamp, 'recvWindow': 60000}
-            query_string = urlencode(payload)
+        # HMAC-SHA256 signing; copying the keyed OpenSSL context skips ipad/opad setup
+        def sign(self, query_string):
+            mac = self._hmac_template.copy()
+            mac.update(query_string.encode('utf-8'))
+            return mac.hexdigest()
+        
+        # Bursty callers can produce identical query strings within one millisecond
+        instance._sign = lru_cache(maxsize=256)(types.MethodType(sign, instance))
+        
+        # Shared keep-alive session, bound to the event loop of the first request
+        def get_session(self):
+            if self._session is None or self._session.closed:
+                self._session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, ssl=False)
+                )
+                # Fire-and-forget ping; once it completes its keep-alive connection is pooled for reuse
+                self._warmup_task = asyncio.ensure_future(cls._preconnect(self._session))
+            return self._session
+        
+        instance._get_session = types.MethodType(get_session, instance)
+        
+        # Send a request and decode the raw body with orjson (no content-type check or str copy)
+        async def request(self, method, url, headers=None, action='Request'):
+            session = self._get_session()
+            # encoded=True stops yarl re-quoting the query (e.g. %3A -> :) after it was signed
+            url = yarl.URL(url, encoded=True)
+            async with session.request(method, url, headers=headers, ssl=False) as response:
+                body = await response.read()
+                if response.status != 200:
+                    # Gateway errors (e.g. HTML 502/503, empty 5xx) are not JSON
+                    try:
+                        data = orjson.loads(body)
+                    except orjson.JSONDecodeError:
+                        data = body.decode('utf-8', errors='replace')
+                    raise BinanceTestnetError(response.status, data, action)
+                return orjson.loads(body)
+        
+        instance._request = types.MethodType(request, instance)
+        
+        # Sign query_string (plus recvWindow/timestamp), send it and decode the response
+        async def signed_request(self, method, path, query_string='', action='Request'):
+            timestamp = time.time_ns() // 1_000_000
+            signed = f"recvWindow=60000&timestamp={timestamp}"
+            if query_string:
+                signed = f"{query_string}&{signed}"
             
-            signature = hmac.new(
-                self.secret.encode('utf-8'),
-                query_string.encode('utf-8'),
-                hashlib.sha256
-            ).hexdigest()
+            url = yarl.URL(f"{BASE_URL}{path}?{signed}&signature={self._sign(signed)}", encoded=True)
             
-            url = f"https://testnet.binancefuture.com/fapi/v2/account?{query_string}&signature={signature}"
-            headers = {'X-MBX-APIKEY': self.apiKey}
+            # Binance verifies the HMAC over the raw query it receives, so re-sign exactly that
+            sent, _, signature = url.raw_query_string.rpartition('&signature=')
+            if sent != signed or self._sign(sent) != signature:
+                raise ValueError(f"{action}: query string was altered after signing")
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers, ssl=False) as response:
-                    data = await response.json()
-                    if response.status != 200:
-                        raise Exception(f"Balance fetch failed: {data}")
-                    
-                    result = {'info': data, 'free': {}, 'used': {}, 'total': {}}
-                    for asset in data.get('assets', []):
-                        currency = asset.get('asset')
-                        if not currency:
-                            continue
-                        total = float(asset.get('walletBalance', 0))
-                        free = float(asset.get('availableBalance', 0))
-                        result[currency] = {'free': free, 'used': total - free, 'total': total}
-                        result['free'][currency] = free
-                        result['total'][currency] = total
-                    return result
+            return await self._request(method, url, self._headers, action)
+        
+        instance._signed_request = types.MethodType(signed_request, instance)
+        
+        # Resolve markets once per symbol instead of on every call
+        async def cached_market(self, symbol):
+            markets = self.markets
+            if not markets:
+                await self.load_markets()
+                markets = self.markets
+            # load_markets(reload=True) installs a new dict, which invalidates the cache
+            if markets is not self._market_cache_source:
+                self._market_cache = {}
+                self._market_cache_source = markets
+            
+            market = self._market_cache.get(symbol)
+            if market is None:
+                market = self.market(symbol)
+                self._market_cache[symbol] = market
+            return market
+        
+        instance._cached_market = types.MethodType(cached_market, instance)
+        
+        # PATCH 1: fetch_balance
+        async def patched_fetch_balance(self, params={}):
+            data = await self._signed_request('GET', '/fapi/v2/account', action='Balance fetch')
+            
+            result = {'info': data, 'free': {}, 'used': {}, 'total': {}}
+            for asset in data.get('assets', []):
+                currency = asset.get('asset')
+                if not currency:
+                    continue
+                total = float(asset.get('walletBalance', 0))
+                free = float(asset.get('availableBalance', 0))
+                result[currency] = {'free': free, 'used': total - free, 'total': total}
+                result['free'][currency] = free
+                result['total'][currency] = total
+            return result
         
         instance.fetch_balance = types.MethodType(patched_fetch_balance, instance)
         
         # PATCH 2: fetch_ticker
+        async def fetch_ticker_uncached(self, symbol):
+            market = await self._cached_market(symbol)
+            url = f"{BASE_URL}/fapi/v1/ticker/24hr?symbol={market['id']}"
+            data = await self._request('GET', url, action='Ticker fetch')
+            return self.parse_ticker(data, market)
+        
         async def patched_fetch_ticker(self, symbol, params={}):
-            if not self.markets:
-                await self.load_markets()
-            
-            market = self.market(symbol)
-            url = f"https://testnet.binancefuture.com/fapi/v1/ticker/24hr?symbol={market['id']}"
+            if self._ticker_ttl <= 0:
+                return await fetch_ticker_uncached(self, symbol)
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, ssl=False) as response:
-                    data = await response.json()
-                    if response.status != 200:
-                        raise Exception(f"Ticker fetch failed: {data}")
-                    return self.parse_ticker(data, market)
+            # Concurrent callers for the same symbol share one in-flight request
+            lock = self._ticker_locks.get(symbol)
+            if lock is None:
+                lock = self._ticker_locks[symbol] = asyncio.Lock()
+            async with lock:
+                entry = self._ticker_cache.get(symbol)
+                if entry is None or time.monotonic() - entry[0] >= self._ticker_ttl:
+                    entry = (time.monotonic(), await fetch_ticker_uncached(self, symbol))
+                    self._ticker_cache[symbol] = entry
+                # Shallow copy so one caller's mutations don't leak into the cache
+                return dict(entry[1])
         
         instance.fetch_ticker = types.MethodType(patched_fetch_ticker, instance)
         
         # PATCH 3: fetch_positions
         async def patched_fetch_positions(self, symbols=None, params={}):
-            timestamp = int(time.time() * 1000)
-            payload = {'timestamp': timestamp, 'recvWindow': 60000}
-            query_string = urlencode(payload)
-            
-            signature = hmac.new(
-                self.secret.encode('utf-8'),
-                query_string.encode('utf-8'),
-                hashlib.sha256
-            ).hexdigest()
+            data = await self._signed_request('GET', '/fapi/v2/positionRisk', action='Positions fetch')
             
-            url = f"https://testnet.binancefuture.com/fapi/v2/positionRisk?{query_string}&signature={signature}"
-            headers = {'X-MBX-APIKEY': self.apiKey}
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers, ssl=False) as response:
-                    data = await response.json()
-                    if response.status != 200:
-                        raise Exception(f"Positions fetch failed: {data}")
-                    
-                    result = []
-                    for item in data:
-                        result.append({
-                            'info': item,
-                            'symbol': item['symbol'],
-                            'contracts': float(item['positionAmt']),
-                            'unrealizedPnl': float(item['unRealizedProfit']),
-                            'leverage': float(item['leverage']),
-                            'side': 'long' if float(item['positionAmt']) > 0 else 'short',
-                            'entryPrice': float(item['entryPrice']),
-                        })
-                    return result
+            # params={'onlyNonZero': True} skips flat positions before building dicts
+            only_non_zero = params.get('onlyNonZero', False)
+            if len(data) < POSITIONS_EXECUTOR_THRESHOLD:
+                return parse_positions(data, only_non_zero)
+            # Large payloads are parsed off the event loop so other coroutines keep running
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, parse_positions, data, only_non_zero)
         
         instance.fetch_positions = types.MethodType(patched_fetch_positions, instance)
         
         # PATCH 4: create_order
         async def patched_create_order(self, symbol, type, side, amount, price=None, params={}):
-            if not self.markets:
-                await self.load_markets()
+            market = await self._cached_market(symbol)
             
-            market = self.market(symbol)
-            timestamp = int(time.time() * 1000)
-            
-            order_params = {
-                'symbol': market['id'],
-                'side': side.upper(),
-                'type': type.upper(),
-                'quantity': str(amount),
-                'timestamp': timestamp,
-                'recvWindow': 60000
-            }
+            values = (market['id'], side.upper(), type.upper(), str(amount))
+            query_string = '&'.join(f"{k}={quote_plus(v)}" for k, v in zip(ORDER_KEYS, values))
+            reserved = RESERVED_ORDER_KEYS
             
             if price and type.upper() == 'LIMIT':
-                order_params['price'] = str(price)
-                order_params['timeInForce'] = params.get('timeInForce', 'GTC')
+                time_in_force = params.get('timeInForce', 'GTC')
+                query_string += f"&price={quote_plus(str(price))}&timeInForce={quote_plus(time_in_force)}"
+                reserved = LIMIT_ORDER_KEYS
             
-            for key, value in params.items():
-                if key not in order_params:
-                    order_params[key] = value
+            extras = encode_query(params, reserved)
+            if extras:
+                query_string += '&' + extras
             
-            query_string = urlencode(order_params)
-            signature = hmac.new(
-                self.secret.encode('utf-8'),
-                query_string.encode('utf-8'),
-                hashlib.sha256
-            ).hexdigest()
+            data = await self._signed_request('POST', '/fapi/v1/order', query_string, action='Order')
+            print(f"✅ Order Success: ID={data.get('orderId')}")
+            return self.parse_order(data, market)
+        
+        instance.create_order = types.MethodType(patched_create_order, instance)
+        
+        # PATCH 5: create_orders (up to 5 orders per signed batchOrders request)
+        async def build_order_batch(self, batch, params):
+            markets = []
+            batch_orders = []
+            for order in batch:
+                market = await self._cached_market(order['symbol'])
+                order_type = order['type'].upper()
+                # Shared params apply to every order; per-order params take precedence
+                order_params = {**params, **(order.get('params') or {})}
+                
+                entry = {
+                    'symbol': market['id'],
+                    'side': order['side'].upper(),
+                    'type': order_type,
+                    'quantity': str(order['amount']),
+                }
+                
+                price = order.get('price')
+                if price and order_type == 'LIMIT':
+                    entry['price'] = str(price)
+                    entry['timeInForce'] = order_params.get('timeInForce', 'GTC')
+                
+                for key, value in order_params.items():
+                    if key not in entry:
+                        entry[key] = value
+                
+                markets.append(market)
+                batch_orders.append(entry)
+            return markets, batch_orders
+        
+        async def post_order_batch(self, markets, batch_orders):
+            query_string = f"batchOrders={encode_value(batch_orders)}"
+            data = await self._signed_request('POST', '/fapi/v1/batchOrders', query_string, action='Batch order')
+            
+            # Each entry is either an order or a per-order {'code', 'msg'} error
+            result = []
+            for item, market in zip(data, markets):
+                if 'orderId' in item:
+                    print(f"✅ Order Success: ID={item['orderId']}")
+                    result.append(self.parse_order(item, market))
+                else:
+                    result.append({'info': item, 'symbol': market['symbol'], 'status': 'rejected'})
+            return result
+        
+        async def patched_create_orders(self, orders, params={}):
+            batches = [orders[i:i + BATCH_ORDER_LIMIT] for i in range(0, len(orders), BATCH_ORDER_LIMIT)]
+            # Resolve every order first so malformed input raises before anything is sent
+            prepared = [await build_order_batch(self, batch, params) for batch in batches]
+            results = await asyncio.gather(
+                *(post_order_batch(self, markets, batch_orders) for markets, batch_orders in prepared),
+                return_exceptions=True,
+            )
             
-            url = f"https://testnet.binancefuture.com/fapi/v1/order?{query_string}&signature={signature}"
-            headers = {'X-MBX-APIKEY': self.apiKey}
+            failures = [r for r in results if isinstance(r, BaseException)]
+            for failure in failures:
+                if not isinstance(failure, Exception):
+                    raise failure
+            if len(failures) == len(results):
+                raise failures[0]
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, ssl=False) as response:
-                    data = await response.json()
-                    if response.status != 200:
-                        raise Exception(f"Order failed: {data}")
-                    print(f"✅ Order Success: ID={data.get('orderId')}")
-                    return self.parse_order(data, market)
+            # A failed batch must not hide the orders other batches already placed
+            result = []
+            for (markets, _), batch_result in zip(prepared, results):
+                if isinstance(batch_result, BinanceTestnetError):
+                    # Binance answered with an error, so none of the batch was placed
+                    result.extend({'info': batch_result, 'symbol': market['symbol'], 'status': 'rejected'}
+                                  for market in markets)
+                elif isinstance(batch_result, Exception):
+                    # Transport failure (timeout, dropped connection): the orders may be live
+                    result.extend({'info': batch_result, 'symbol': market['symbol'], 'status': 'unknown'}
+                                  for market in markets)
+                else:
+                    result.extend(batch_result)
+            return result
         
-        instance.create_order = types.MethodType(patched_create_order, instance)
+        instance.create_orders = types.MethodType(patched_create_orders, instance)
+        
+        # PATCH 6: close_session (async teardown; ccxt's synchronous close() is left intact
+        # because Exchange.__del__ calls it)
+        async def close_session(self):
+            if self._warmup_task is not None and not self._warmup_task.done():
+                self._warmup_task.cancel()
+            self._sign.cache_clear()
+            if self._session is not None and not self._session.closed:
+                await self._session.close()
+            self.close()
+        
+        instance.close_session = types.MethodType(close_session, instance)
         print("✅ All patches applied!")
 